@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # -*- coding: utf-8 -*-
 #
 # This script builds unaccent.rules on standard output when given the
@@ -26,33 +26,12 @@
 # [1] https://www.unicode.org/Public/${UNICODE_VERSION}/ucd/UnicodeData.txt
 # [2] https://raw.githubusercontent.com/unicode-org/cldr/${TAG}/common/transforms/Latin-ASCII.xml
 
-# BEGIN: Python 2/3 compatibility - remove when Python 2 compatibility dropped
-# The approach is to be Python3 compatible with Python2 "backports".
-from __future__ import print_function
-from __future__ import unicode_literals
-# END: Python 2/3 compatibility - remove when Python 2 compatibility dropped
-
 import argparse
-import codecs
 import re
+import string
 import sys
 import xml.etree.ElementTree as ET
 
-# BEGIN: Python 2/3 compatibility - remove when Python 2 compatibility dropped
-if sys.version_info[0] <= 2:
-    # Encode stdout as UTF-8, so we can just print to it
-    sys.stdout = codecs.getwriter('utf8')(sys.stdout)
-
-    # Map Python 2's chr to unichr
-    chr = unichr
-
-    # Python 2 and 3 compatible bytes call
-    def bytes(source, encoding='ascii', errors='strict'):
-        return source.encode(encoding=encoding, errors=errors)
-else:
-# END: Python 2/3 compatibility - remove when Python 2 compatibility dropped
-    sys.stdout = codecs.getwriter('utf8')(sys.stdout.buffer)
-
 # The ranges of Unicode characters that we consider to be "plain letters".
 # For now we are being conservative by including only Latin and Greek.  This
 # could be extended in future based on feedback from people with relevant
@@ -62,6 +41,11 @@ PLAIN_LETTER_RANGES = ((ord('a'), ord('z')), # Latin lower case
                        (0x03b1, 0x03c9),     # GREEK SMALL LETTER ALPHA, GREEK SMALL LETTER OMEGA
                        (0x0391, 0x03a9))     # GREEK CAPITAL LETTER ALPHA, GREEK CAPITAL LETTER OMEGA
 
+# The same, expanded into a mapping from codepoint id to character, for fast
+# membership tests and so that the output characters are only built once.
+PLAIN_LETTERS = {id: chr(id) for begin, end in PLAIN_LETTER_RANGES
+                 for id in range(begin, end + 1)}
+
 # Combining marks follow a "base" character, and result in a composite
 # character. Example: "U&'A\0300'"produces "À".There are three types of
 # combining marks: enclosing (Me), non-spacing combining (Mn), spacing
@@ -74,70 +58,113 @@ COMBINING_MARK_RANGES = ((0x0300, 0x0362),  # Mn: Accents, IPA
                          (0x20dd, 0x20E0),  # Me: Symbols
                          (0x20e2, 0x20e4),) # Me: Screen, keycap, triangle
 
-def print_record(codepoint, letter):
+# The same, expanded into a set of codepoint ids for fast membership tests.
+COMBINING_MARKS = frozenset(id for begin, end in COMBINING_MARK_RANGES
+                            for id in range(begin, end + 1))
+
+# General categories of diacritical marks (combining codepoints).
+MARK_CATEGORIES = frozenset(("Mn", "Me", "Mc"))
+
+# Rule of the CLDR Latin-ASCII transliterator.  Only needed for rules that
+# split_cldr_rule() can't take apart with plain string operations.
+CLDR_RULE_PATTERN = re.compile(r'^(?:(.)|(\\u[0-9a-fA-F]{4})) \u2192 (?:\'(.+)\'|(.+)) ;')
+
+def format_record(codepoint, letter):
+    """Return the output line, including newline, for one rule."""
     if letter:
-        output = chr(codepoint) + "\t" + letter
+        return chr(codepoint) + "\t" + letter + "\n"
     else:
-        output = chr(codepoint)
-
-    print(output)
+        return chr(codepoint) + "\n"
 
 class Codepoint:
+    # There is one of these for every entry in UnicodeData.txt, so avoid
+    # a per-instance __dict__.
+    __slots__ = ('id', 'general_category', 'combining_ids',
+                 'is_letter_category', 'is_mark_category')
+
     def __init__(self, id, general_category, combining_ids):
         self.id = id
         self.general_category = general_category
         self.combining_ids = combining_ids
+        # Precompute the category tests used on the hot paths.
+        self.is_letter_category = general_category.startswith('L')
+        self.is_mark_category = general_category in MARK_CATEGORIES
 
 def is_mark_to_remove(codepoint):
     """Return true if this is a combining mark to remove."""
-    if not is_mark(codepoint):
-        return False
-
-    for begin, end in COMBINING_MARK_RANGES:
-        if codepoint.id >= begin and codepoint.id <= end:
-            return True
-    return False
+    return is_mark(codepoint) and codepoint.id in COMBINING_MARKS
 
 def is_plain_letter(codepoint):
     """Return true if codepoint represents a "plain letter"."""
-    for begin, end in PLAIN_LETTER_RANGES:
-      if codepoint.id >= begin and codepoint.id <= end:
-        return True
-    return False
+    return codepoint.id in PLAIN_LETTERS
 
 def is_mark(codepoint):
     """Returns true for diacritical marks (combining codepoints)."""
-    return codepoint.general_category in ("Mn", "Me", "Mc")
+    return codepoint.is_mark_category
+
+# Results of is_letter_with_marks(), keyed by codepoint id.  The same base
+# letters are looked up over and over again, both from main() and from
+# is_ligature(), so remember the answer for each codepoint.
+letter_with_marks_cache = {}
 
 def is_letter_with_marks(codepoint, table):
     """Returns true for letters combined with one or more marks."""
+    result = letter_with_marks_cache.get(codepoint.id)
+    if result is None:
+        result = compute_letter_with_marks(codepoint, table)
+        letter_with_marks_cache[codepoint.id] = result
+    return result
+
+def compute_letter_with_marks(codepoint, table):
+    """Uncached worker for is_letter_with_marks()."""
     # See https://www.unicode.org/reports/tr44/tr44-14.html#General_Category_Values
 
-    # Letter may have no combining characters, in which case it has
-    # no marks.
-    if len(codepoint.combining_ids) == 1:
-        return False
-
-    # A letter without diacritical marks has none of them.
-    if any(is_mark(table[i]) for i in codepoint.combining_ids[1:]) is False:
-        return False
-
-    # Check if the base letter of this letter has marks.
-    codepoint_base = codepoint.combining_ids[0]
-    if (is_plain_letter(table[codepoint_base]) is False and \
-        is_letter_with_marks(table[codepoint_base], table) is False):
-        return False
+    # Walk down the chain of base letters until we reach a plain letter,
+    # or something that is not a letter with marks.
+    while True:
+        combining_ids = codepoint.combining_ids
+
+        # Letter may have no combining characters, in which case it has
+        # no marks.
+        if len(combining_ids) <= 1:
+            return False
+
+        # A letter without diacritical marks has none of them.
+        for i in combining_ids[1:]:
+            if is_mark(table[i]):
+                break
+        else:
+            return False
+
+        # Check if the base letter of this letter has marks.
+        codepoint = table[combining_ids[0]]
+        if is_plain_letter(codepoint):
+            return True
 
-    return True
+        result = letter_with_marks_cache.get(codepoint.id)
+        if result is not None:
+            return result
 
 def is_letter(codepoint, table):
     """Return true for letter with or without diacritical marks."""
     return is_plain_letter(codepoint) or is_letter_with_marks(codepoint, table)
 
+# Results of get_plain_letter(), keyed by codepoint id.  Many precomposed
+# letters share the same chain of bases, so each chain is only walked once.
+plain_letter_cache = {}
+
 def get_plain_letter(codepoint, table):
     """Return the base codepoint without marks. If this codepoint has more
     than one combining character, do a recursive lookup on the table to
     find out its plain base letter."""
+    result = plain_letter_cache.get(codepoint.id)
+    if result is None:
+        result = compute_plain_letter(codepoint, table)
+        plain_letter_cache[codepoint.id] = result
+    return result
+
+def compute_plain_letter(codepoint, table):
+    """Uncached worker for get_plain_letter()."""
     if is_letter_with_marks(codepoint, table):
         if len(table[codepoint.combining_ids[0]].combining_ids) > 1:
             return get_plain_letter(table[codepoint.combining_ids[0]], table)
@@ -154,49 +181,76 @@ def get_plain_letter(codepoint, table):
 
 def is_ligature(codepoint, table):
     """Return true for letters combined with letters."""
-    return all(is_letter(table[i], table) for i in codepoint.combining_ids)
+    for i in codepoint.combining_ids:
+        if not is_letter(table[i], table):
+            return False
+    return True
 
 def get_plain_letters(codepoint, table):
     """Return a list of plain letters from a ligature."""
     assert(is_ligature(codepoint, table))
     return [get_plain_letter(table[id], table) for id in codepoint.combining_ids]
 
-def parse_cldr_latin_ascii_transliterator(latinAsciiFilePath):
-    """Parse the XML file and return a set of tuples (src, trg), where "src"
-    is the original character and "trg" the substitute."""
-    charactersSet = set()
-
-    # RegEx to parse rules
-    rulePattern = re.compile(r'^(?:(.)|(\\u[0-9a-fA-F]{4})) \u2192 (?:\'(.+)\'|(.+)) ;')
-
-    # construct tree from XML
-    transliterationTree = ET.parse(latinAsciiFilePath)
-    transliterationTreeRoot = transliterationTree.getroot()
+def split_cldr_rule(rule):
+    """Split a rule of the form "src \u2192 trg ;" into a tuple (src, trg),
+    where "trg" still has its quotes escaped.  Return None if the line is
+    not a rule."""
+    # Nearly all rules are simple enough to take apart with string
+    # operations.  Only a line with several " ;" is ambiguous that way, so
+    # leave that, and anything else unusual, to the regular expression.
+    src, sep, rest = rule.partition(' \u2192 ')
+    if sep and rest.count(' ;') == 1:
+        trg = rest.partition(' ;')[0]
+        if len(src) == 6 and src.startswith('\\u') and \
+           all(c in string.hexdigits for c in src[2:]):
+            src = chr(int(src[2:], 16))
+        if len(src) == 1 and trg:
+            if len(trg) > 2 and trg[0] == "'" and trg[-1] == "'":
+                trg = trg[1:-1]
+            return (src, trg)
+
+    matches = CLDR_RULE_PATTERN.search(rule)
+
+    # The regular expression capture four groups corresponding
+    # to the characters.
+    #
+    # Group 1: plain "src" char. Empty if group 2 is not.
+    # Group 2: unicode-escaped "src" char (e.g. "\u0110"). Empty if group 1 is not.
+    #
+    # Group 3: plain "trg" char. Empty if group 4 is not.
+    # Group 4: plain "trg" char between quotes. Empty if group 3 is not.
+    if matches is None:
+        return None
+
+    src = matches.group(1) if matches.group(1) is not None else chr(int(matches.group(2)[2:], 16))
+    trg = matches.group(3) if matches.group(3) is not None else matches.group(4)
+    return (src, trg)
+
+def parse_cldr_latin_ascii_transliterator(latinAsciiFilePath, charactersMap):
+    """Parse the XML file and add its rules to charactersMap, mapping "src"
+    to "trg", where "src" is the codepoint of the original character and
+    "trg" the substitute."""
 
     # Fetch all the transliteration rules.  Since release 29 of Latin-ASCII.xml
     # all the transliteration rules are located in a single tRule block with
-    # all rules separated into separate lines.
-    blockRules = transliterationTreeRoot.findall("./transforms/transform/tRule")
+    # all rules separated into separate lines.  Only the text of that block
+    # is needed, so parse the XML incrementally and throw away each element
+    # once it is complete rather than building the whole tree.
+    blockRules = []
+    for event, element in ET.iterparse(latinAsciiFilePath):
+        if element.tag == "tRule":
+            blockRules.append(element.text)
+        element.clear()
     assert(len(blockRules) == 1)
 
     # Split the block of rules into one element per line.
-    rules = blockRules[0].text.splitlines()
+    rules = blockRules[0].splitlines()
 
     # And finish the processing of each individual rule.
     for rule in rules:
-        matches = rulePattern.search(rule)
-
-        # The regular expression capture four groups corresponding
-        # to the characters.
-        #
-        # Group 1: plain "src" char. Empty if group 2 is not.
-        # Group 2: unicode-escaped "src" char (e.g. "\u0110"). Empty if group 1 is not.
-        #
-        # Group 3: plain "trg" char. Empty if group 4 is not.
-        # Group 4: plain "trg" char between quotes. Empty if group 3 is not.
-        if matches is not None:
-            src = matches.group(1) if matches.group(1) is not None else bytes(matches.group(2), 'UTF-8').decode('unicode-escape')
-            trg = matches.group(3) if matches.group(3) is not None else matches.group(4)
+        parts = split_cldr_rule(rule)
+        if parts is not None:
+            src, trg = parts
 
             # "'" and """ are escaped
             trg = trg.replace("\\'", "'").replace('\\"', '"')
@@ -204,78 +258,75 @@ def parse_cldr_latin_ascii_transliterator(latinAsciiFilePath):
             # the parser of unaccent only accepts non-whitespace characters
             # for "src" and "trg" (see unaccent.c)
             if not src.isspace() and not trg.isspace():
-                charactersSet.add((ord(src), trg))
-
-    return charactersSet
-
-def special_cases():
-    """Returns the special cases which are not handled by other methods"""
-    charactersSet = set()
+                charactersMap[ord(src)] = trg
 
+def special_cases(charactersMap):
+    """Adds the special cases which are not handled by other methods to
+    charactersMap"""
     # Cyrillic
-    charactersSet.add((0x0401, u"\u0415")) # CYRILLIC CAPITAL LETTER IO
-    charactersSet.add((0x0451, u"\u0435")) # CYRILLIC SMALL LETTER IO
+    charactersMap[0x0401] = u"\u0415" # CYRILLIC CAPITAL LETTER IO
+    charactersMap[0x0451] = u"\u0435" # CYRILLIC SMALL LETTER IO
 
     # Symbols of "Letterlike Symbols" Unicode Block (U+2100 to U+214F)
-    charactersSet.add((0x2103, u"\xb0C")) # DEGREE CELSIUS
-    charactersSet.add((0x2109, u"\xb0F")) # DEGREE FAHRENHEIT
-    charactersSet.add((0x2117, "(P)")) # SOUND RECORDING COPYRIGHT
-
-    return charactersSet
+    charactersMap[0x2103] = u"\xb0C" # DEGREE CELSIUS
+    charactersMap[0x2109] = u"\xb0F" # DEGREE FAHRENHEIT
+    charactersMap[0x2117] = "(P)" # SOUND RECORDING COPYRIGHT
 
 def main(args):
-    # https://www.unicode.org/reports/tr44/tr44-14.html#Character_Decomposition_Mappings
-    decomposition_type_pattern = re.compile(" *<[^>]*> *")
-
     table = {}
-    all = []
 
-    # unordered set for ensure uniqueness
-    charactersSet = set()
+    # map each codepoint to its substitute (None for marks to remove); a
+    # dict keyed by codepoint ensures uniqueness
+    charactersMap = {}
 
     # read file UnicodeData.txt
-    with codecs.open(
+    with open(
       args.unicodeDataFilePath, mode='r', encoding='UTF-8',
       ) as unicodeDataFile:
         # read everything we need into memory
         for line in unicodeDataFile:
-            fields = line.split(";")
+            # only the first six fields are used, so leave the rest of the
+            # line unsplit
+            fields = line.split(";", 6)
             if len(fields) > 5:
                 # https://www.unicode.org/reports/tr44/tr44-14.html#UnicodeData.txt
                 general_category = fields[2]
+                # https://www.unicode.org/reports/tr44/tr44-14.html#Character_Decomposition_Mappings
+                # The decomposition type tag, such as "<compat>", is always
+                # at the front of the field when present; strip it.
                 decomposition = fields[5]
-                decomposition = re.sub(decomposition_type_pattern, ' ', decomposition)
+                if decomposition.startswith('<'):
+                    decomposition = decomposition.partition('>')[2]
                 id = int(fields[0], 16)
-                combining_ids = [int(s, 16) for s in decomposition.split(" ") if s != ""]
+                combining_ids = [int(s, 16) for s in decomposition.split()]
                 codepoint = Codepoint(id, general_category, combining_ids)
                 table[id] = codepoint
-                all.append(codepoint)
 
     # walk through all the codepoints looking for interesting mappings
-    for codepoint in all:
-        if codepoint.general_category.startswith('L') and \
+    for codepoint in table.values():
+        if codepoint.is_letter_category and \
            len(codepoint.combining_ids) > 1:
             if is_letter_with_marks(codepoint, table):
-                charactersSet.add((codepoint.id,
-                             chr(get_plain_letter(codepoint, table).id)))
+                charactersMap[codepoint.id] = \
+                    PLAIN_LETTERS[get_plain_letter(codepoint, table).id]
             elif args.noLigaturesExpansion is False and is_ligature(codepoint, table):
-                charactersSet.add((codepoint.id,
-                             "".join(chr(combining_codepoint.id)
-                                     for combining_codepoint \
-                                     in get_plain_letters(codepoint, table))))
+                charactersMap[codepoint.id] = \
+                    "".join(PLAIN_LETTERS[combining_codepoint.id]
+                            for combining_codepoint \
+                            in get_plain_letters(codepoint, table))
         elif is_mark_to_remove(codepoint):
-            charactersSet.add((codepoint.id, None))
+            charactersMap[codepoint.id] = None
 
     # add CLDR Latin-ASCII characters
     if not args.noLigaturesExpansion:
-        charactersSet |= parse_cldr_latin_ascii_transliterator(args.latinAsciiFilePath)
-        charactersSet |= special_cases()
-
-    # sort for more convenient display
-    charactersList = sorted(charactersSet, key=lambda characterPair: characterPair[0])
-
-    for characterPair in charactersList:
-        print_record(characterPair[0], characterPair[1])
+        parse_cldr_latin_ascii_transliterator(args.latinAsciiFilePath, charactersMap)
+        special_cases(charactersMap)
+
+    # sort for more convenient display, and write it all out at once as
+    # UTF-8, whatever the locale's encoding for stdout is
+    output = "".join(format_record(codepoint, letter)
+                     for codepoint, letter in sorted(charactersMap.items()))
+    sys.stdout.buffer.write(output.encode('UTF-8'))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='This script builds unaccent.rules on standard output when given the contents of UnicodeData.txt and Latin-ASCII.xml given as arguments.')